@@ -0,0 +1,94 @@
+""" This module contains an int8 ONNX Runtime backend for local embeddings. """
+
+import os
+import shutil
+
+from llama_index import ServiceContext, set_global_service_context
+from llama_index.embeddings import OptimumEmbedding
+
+DEFAULT_CACHE_FOLDER = os.path.join(
+    os.path.expanduser("~"), ".cache", "LlamaDocIndexer", "onnx"
+)
+
+
+def supports_int8():
+    """Checks if the CPU has the VNNI instructions that make int8 faster."""
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            cpuinfo = f.read()
+    except OSError:
+        return False
+    for line in cpuinfo.splitlines():
+        if line.startswith("flags"):
+            flags = line.split(":", 1)[1].split()
+            return "avx512_vnni" in flags or "avx_vnni" in flags
+    return False
+
+
+def quantize_model(fp32_folder, int8_folder):
+    """Quantizes the weights of an exported model to int8."""
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError as e:
+        raise ImportError(
+            "onnxruntime is required for int8 embeddings, "
+            "install it with `pip install optimum[onnxruntime]`"
+        ) from e
+
+    # quantize into a temporary folder so a crash leaves no partial model
+    tmp_folder = int8_folder + ".tmp"
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    shutil.copytree(
+        fp32_folder, tmp_folder, ignore=shutil.ignore_patterns("*.onnx")
+    )
+    quantize_dynamic(
+        os.path.join(fp32_folder, "model.onnx"),
+        os.path.join(tmp_folder, "model.onnx"),
+        weight_type=QuantType.QInt8,
+    )
+    os.replace(tmp_folder, int8_folder)
+
+
+def export_model(model_name, cache_folder=DEFAULT_CACHE_FOLDER):
+    """Exports a model to ONNX once and returns the folder to load it from."""
+    fp32_folder = os.path.join(cache_folder, model_name.replace("/", "--"))
+    if not os.path.isdir(fp32_folder):
+        OptimumEmbedding.create_and_save_optimum_model(model_name, fp32_folder)
+    # int8 is slower than fp32 on CPUs without VNNI
+    if not supports_int8():
+        return fp32_folder
+
+    int8_folder = fp32_folder + "-int8"
+    if not os.path.isdir(int8_folder):
+        quantize_model(fp32_folder, int8_folder)
+    return int8_folder
+
+
+def load_embedding(model_name, cache_folder=DEFAULT_CACHE_FOLDER, **kwargs):
+    """Returns an ONNX Runtime embedding model for a HuggingFace model."""
+    folder = export_model(model_name, cache_folder)
+    return OptimumEmbedding(folder_name=folder, **kwargs)
+
+
+def load_session(embed_model, threads=None):
+    """Loads the ONNX Runtime session of an embedding model again."""
+    from onnxruntime import SessionOptions
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+    session_options = SessionOptions()
+    if threads is not None:
+        session_options.intra_op_num_threads = threads
+    embed_model._model = ORTModelForFeatureExtraction.from_pretrained(
+        embed_model.folder_name, session_options=session_options
+    )
+
+
+def use_onnx_embedding(
+    model_name, cache_folder=DEFAULT_CACHE_FOLDER, **kwargs
+):
+    """Makes an ONNX Runtime embedding model the global default."""
+    embed_model = load_embedding(model_name, cache_folder, **kwargs)
+    service_context = ServiceContext.from_defaults(embed_model=embed_model)
+    set_global_service_context(service_context)
+    return embed_model
@@ -1,26 +1,277 @@
-import hashlib
-import json
+import asyncio
+import functools
+import multiprocessing
 import os
+import queue
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import (
+    BrokenExecutor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
 
+import llama_index
 from llama_index import (
     ComposableGraph,
     Document,
     ListIndex,
+    ServiceContext,
     StorageContext,
     VectorStoreIndex,
     load_index_from_storage,
 )
+from llama_index.ingestion import run_transformations
+from llama_index.schema import IndexNode, MetadataMode
 
 from LlamaDocIndexer.io.documents import (
+    TEXT_EXTENSIONS,
+    dump_json,
+    file_signature,
     is_plain_text,
+    is_text_head,
+    iter_pdf_pages,
+    link_index,
     load_index,
     make_dirs,
-    read_pdf,
+    read_head,
+    read_json,
     read_plain_text,
+    read_xls,
     read_xlsx,
     save_index,
+    write_json,
+)
+from LlamaDocIndexer.utilities.hashes import (
+    hash_file,
+    hash_path,
+    hash_strings,
+)
+from LlamaDocIndexer.utilities.patterns import ignored_files_to_regex
+
+# concurrent requests to a remote embedding model
+DEFAULT_THREAD_WORKERS = 4
+# concurrent file reads for fingerprints, cheap next to embedding
+IO_WORKERS = 64
+# small files are embedded together, in batches of up to BATCH_FILES
+BATCH_FILES = 16
+BATCH_CHARS = 20_000
+# seconds a batch waits for more files before it is embedded
+BATCH_LINGER = 0.05
+# number of query responses kept for repeated questions
+QUERY_CACHE_SIZE = 128
+# embedding models that run inside the python process
+LOCAL_EMBEDDINGS = (
+    "HuggingFaceEmbedding",
+    "InstructorEmbedding",
+    "OptimumEmbedding",
+    "FastEmbedEmbedding",
+    "ClipEmbedding",
 )
-from LlamaDocIndexer.utilities.patterns import ignored_files_to_patterns
+
+# summaries are generated from the beginning of each document
+SUMMARY_CHARS = 4000
+SUMMARY_QUESTION = "Please summarise this document."
+SUMMARY_PROMPT = SUMMARY_QUESTION + "\n\n{text}"
+
+
+def _file_extension(file_name):
+    """Returns the lowercased extension of a file name."""
+    dot = file_name.rfind(".")
+    return file_name[dot:].lower() if dot > 0 else ""
+
+
+def _read_pdf_pages(path):
+    """Reads the non-empty pages of a pdf file."""
+    # keep pages apart so they are parsed into nodes one at a time
+    return [page for page in iter_pdf_pages(path) if page]
+
+
+def _read_xlsx_pages(path):
+    """Reads an xlsx file as a single page."""
+    return [read_xlsx(path)]
+
+
+def _read_xls_pages(path):
+    """Reads an xls file as a single page."""
+    return [read_xls(path)]
+
+
+# readers of the supported file types that are not plain text
+READERS = {
+    ".pdf": _read_pdf_pages,
+    ".xlsx": _read_xlsx_pages,
+    ".xls": _read_xls_pages,
+}
+
+
+def _run_coroutine(coroutine):
+    """Runs a coroutine to completion, also from inside a running loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # notebooks and async applications already run a loop in this thread
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def _start_method():
+    """Returns the start method of new processes without fixing it."""
+    method = multiprocessing.get_start_method(allow_none=True)
+    # the first supported method is the platform default
+    return method or multiprocessing.get_all_start_methods()[0]
+
+
+def _embedding_is_local():
+    """Checks if the global embedding model runs locally and can be forked."""
+    service_context = llama_index.global_service_context
+    if service_context is None:
+        return False
+    # worker processes only inherit the global service context when forked
+    if _start_method() != "fork":
+        return False
+    return type(service_context.embed_model).__name__ in LOCAL_EMBEDDINGS
+
+
+# service context resolved from the global one, see _get_service_context
+_service_context = None
+_service_context_source = None
+
+
+def _get_service_context():
+    """Returns the service context for indices, resolved once."""
+    global _service_context, _service_context_source
+    source = llama_index.global_service_context
+    # resolve again whenever the global service context is replaced
+    if _service_context is None or _service_context_source is not source:
+        _service_context = ServiceContext.from_defaults()
+        _service_context_source = source
+    return _service_context
+
+
+def _generate_indices(batch):
+    """Embeds the pages of several files at once and returns their indices."""
+    service_context = _get_service_context()
+    nodes_list = [
+        run_transformations(
+            [Document(text=page) for page in pages],
+            service_context.transformations,
+        )
+        for pages in batch
+    ]
+    # one embedding call for the nodes of all files in the batch
+    nodes = [node for file_nodes in nodes_list for node in file_nodes]
+    embeddings = service_context.embed_model.get_text_embedding_batch(
+        [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    )
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    # nodes with an embedding are not embedded again by the index
+    return [
+        VectorStoreIndex(nodes=file_nodes, service_context=service_context)
+        for file_nodes in nodes_list
+    ]
+
+
+def _init_embedding_worker():
+    """Prepares a forked worker to embed with a single thread."""
+    # every worker takes a core, more model threads oversubscribe them
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(1)
+    service_context = llama_index.global_service_context
+    if service_context is None:
+        return
+    # onnx runtime sessions are not safe to use after a fork
+    embed_model = service_context.embed_model
+    if type(embed_model).__name__ == "OptimumEmbedding":
+        from LlamaDocIndexer.backends.onnx_embed import load_session
+
+        load_session(embed_model, threads=1)
+
+
+def _run_embedding_task(batch):
+    """Embeds files in a worker process and returns the index states."""
+    indices = _generate_indices(batch)
+    return [index.storage_context.to_dict() for index in indices]
+
+
+class _EmbeddingBatcher:
+    """Collects small files so that their pages are embedded together."""
+
+    def __init__(self, sem, executor):
+        self.sem = sem
+        self.executor = executor
+        self._pending = []
+        self._running = set()
+        self._timer = None
+
+    async def embed(self, pages):
+        """Returns the index of some pages once their batch is embedded."""
+        # large files fill a batch by themselves
+        if sum(len(page) for page in pages) > BATCH_CHARS:
+            async with self.sem:
+                indices = await self._generate([pages])
+            return indices[0]
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((pages, future))
+        if len(self._pending) >= BATCH_FILES:
+            self._flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(BATCH_LINGER, self._flush)
+        return await future
+
+    def _flush(self):
+        """Starts embedding the pending files."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._run(batch))
+        # keep a reference so the task is not collected while running
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch):
+        """Embeds a batch of files and resolves their futures."""
+        try:
+            async with self.sem:
+                indices = await self._generate([pages for pages, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # embed the files one by one so a bad file only fails itself
+            for item in batch:
+                await self._run([item])
+            return
+        for (_, future), index in zip(batch, indices):
+            future.set_result(index)
+
+    async def _generate(self, batch):
+        """Embeds a batch of files in the executor."""
+        # llama_index has no async index construction
+        loop = asyncio.get_running_loop()
+        if not isinstance(self.executor, ProcessPoolExecutor):
+            return await loop.run_in_executor(
+                self.executor, _generate_indices, batch
+            )
+        states = await loop.run_in_executor(
+            self.executor, _run_embedding_task, batch
+        )
+        service_context = _get_service_context()
+        return [
+            load_index_from_storage(
+                StorageContext.from_dict(state),
+                service_context=service_context,
+            )
+            for state in states
+        ]
 
 
 class Indexer:
@@ -33,205 +284,549 @@ class Indexer:
         ignored_folders=None,
         ignored_files=None,
         depth=3,
+        types=None,
+        workers=None,
+        executor="auto",
     ):
         self.folder_path = folder_path
         self.index_path = index_path
         self.ignored_folders = ignored_folders
         self.ignored_files = ignored_files
         self.depth = depth
+        self.types = types
+        self.workers = workers
+        self.executor = executor
         self.indices = {"menu": {}}
         self.query_engine = None
+        self._query_engine_key = None
+        self._engine_cache = {}
+        self._query_cache = OrderedDict()
+        self._menu_lock = threading.Lock()
+        self._menu_bytes = None
+        self._executor = None
         self.initiate()
 
     def initiate(self):
         """Initiates the indexer."""
         if self.index_path is None:
             self.index_path = os.path.join(self.folder_path, ".indices")
+        self._folder_prefix_len = len(self.folder_path.rstrip(os.sep)) + 1
         if self.ignored_folders is None:
             self.ignored_folders = [".indices"]
         else:
             self.ignored_folders.append(".indices")
+        self._ignored_folders = frozenset(self.ignored_folders)
         if self.ignored_files is None:
             self.ignored_files = []
-        self.ignored_patterns = ignored_files_to_patterns(self.ignored_files)
+        # one alternation lets a single regex scan replace the pattern loop
+        self._ignored_re = ignored_files_to_regex(self.ignored_files)
+        self._types = None
+        if self.types is not None:
+            self._types = frozenset(t.lower() for t in self.types)
+        # paths whose contents changed are evicted by discover_files
+        self._supported_cache = {}
+        # cpu bound local models need processes, remote ones only threads
+        if self.executor == "process" or (
+            self.executor == "auto" and _embedding_is_local()
+        ):
+            # spawned workers would embed with the default model instead
+            if _start_method() != "fork":
+                raise ValueError(
+                    "The process executor needs the fork start method"
+                )
+            self._executor_cls = ProcessPoolExecutor
+            default_workers = os.cpu_count() or 1
+        elif self.executor in ("auto", "thread"):
+            self._executor_cls = ThreadPoolExecutor
+            default_workers = DEFAULT_THREAD_WORKERS
+        else:
+            raise ValueError(f"Unsupported executor: {self.executor!r}")
+        if self.workers is None:
+            self.workers = default_workers
         make_dirs(self.index_path)
         # load menu
         menu_path = os.path.join(self.index_path, "menu.json")
         if os.path.isfile(menu_path):
-            with open(menu_path, "r", encoding="utf-8") as f:
-                self.indices["menu"] = json.load(f)
+            self.indices["menu"] = read_json(menu_path)
+            self._menu_bytes = dump_json(self.indices["menu"])
         else:
             self.indices["menu"] = {}
-            with open(menu_path, "w", encoding="utf-8") as f:
-                json.dump(self.indices["menu"], f, indent=4)
+            self._save_menu()
 
+        self.migrate_menu()
         self.load_indices()
+        # unchanged files are skipped by path without hashing them
+        self._modified = {
+            value["path"]: value["modified"]
+            for value in self.indices["menu"].values()
+        }
+        # map file contents to the index that already embeds them
+        self._content_index = {
+            value["content_hash"]: path_hash
+            for path_hash, value in self.indices["menu"].items()
+            if "content_hash" in value
+        }
 
     def generate_index(self, text):
-        """Generates an index from text."""
-        document = Document(text=text)
-        index = VectorStoreIndex.from_documents([document])
-        return index
-
-    def generate_summary(self, index):
-        """Generates a summary from an index."""
-        engine = index.as_query_engine()
-        summary = engine.query("Please summarise this document.")
-        return str(summary)
+        """Generates an index from text or a list of pages."""
+        pages = [text] if isinstance(text, str) else text
+        return _generate_indices([pages])[0]
+
+    def generate_summary(self, index, text=None):
+        """Generates a summary from the beginning of a document."""
+        if text is None:
+            # without the text the index itself is asked for a summary
+            engine = index.as_query_engine()
+            return str(engine.query(SUMMARY_QUESTION))
+        llm = index.service_context.llm
+        prompt = SUMMARY_PROMPT.format(text=text[:SUMMARY_CHARS])
+        return llm.complete(prompt).text
+
+    async def agenerate_summary(self, index, text):
+        """Generates a summary without blocking the loop."""
+        llm = index.service_context.llm
+        prompt = SUMMARY_PROMPT.format(text=text[:SUMMARY_CHARS])
+        response = await llm.acomplete(prompt)
+        return response.text
+
+    def _save_menu(self):
+        """Writes the menu atomically through a temporary file."""
+        menu_path = os.path.join(self.index_path, "menu.json")
+        tmp_path = menu_path + ".tmp"
+        with self._menu_lock:
+            data = dump_json(self.indices["menu"])
+            # skip the write when the menu on disk is already up to date
+            if data == self._menu_bytes:
+                return
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, menu_path)
+            self._menu_bytes = data
+
+    def migrate_menu(self):
+        """Moves indices stored under an outdated path hash to the current."""
+        menu = {}
+        for path_hash, value in self.indices["menu"].items():
+            new_hash = hash_path(value["path"])
+            if new_hash != path_hash:
+                old_folder = os.path.join(self.index_path, path_hash)
+                new_folder = os.path.join(self.index_path, new_hash)
+                if os.path.isdir(old_folder):
+                    if os.path.isdir(new_folder):
+                        shutil.rmtree(new_folder)
+                    os.rename(old_folder, new_folder)
+            menu[new_hash] = value
+        if list(menu) == list(self.indices["menu"]):
+            return
+
+        self.indices["menu"] = menu
+        self._save_menu()
 
     def load_indices(self):
         """Loads the indices from the index folder."""
-        for path_hash in self.indices["menu"]:
-            data_path = os.path.join(self.index_path, path_hash, "data.json")
-            if not os.path.isfile(data_path):
+        migrated = False
+        for path_hash, value in list(self.indices["menu"].items()):
+            # files in folders ignored since they were indexed are dropped
+            folders = os.path.dirname(value["path"]).split(os.sep)
+            if not self._ignored_folders.isdisjoint(folders):
+                del self.indices["menu"][path_hash]
+                continue
+            index_folder = os.path.join(self.index_path, path_hash)
+            if not os.path.isdir(os.path.join(index_folder, "index")):
                 del self.indices["menu"][path_hash]
                 continue
 
-            with open(data_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                index_path = os.path.join(self.index_path, path_hash, "index")
-                self.indices[path_hash] = {
-                    "summary": data["summary"],
-                    "index": load_index(index_path),
-                }
+            # the summary is kept in the menu so data.json, which holds
+            # the whole text, is not read at startup
+            if "summary" not in value:
+                data_path = os.path.join(index_folder, "data.json")
+                if not os.path.isfile(data_path):
+                    del self.indices["menu"][path_hash]
+                    continue
+                value["summary"] = read_json(data_path)["summary"]
+                migrated = True
+            # indices are loaded on first use, see get_index
+            self.indices[path_hash] = {
+                "summary": value["summary"],
+                "index": None,
+            }
+        if migrated:
+            self._save_menu()
+
+    def get_index(self, path_hash):
+        """Returns the index of a file, loading it on first use."""
+        value = self.indices[path_hash]
+        if value["index"] is None:
+            index_path = os.path.join(self.index_path, path_hash, "index")
+            value["index"] = load_index(
+                index_path, service_context=_get_service_context()
+            )
+        return value["index"]
+
+    def load_file_indices(self, path_hashes):
+        """Loads the indices of some files in parallel."""
+        missing = [
+            path_hash
+            for path_hash in path_hashes
+            if self.indices[path_hash]["index"] is None
+        ]
+        if not missing:
+            return
+        index_paths = [
+            os.path.join(self.index_path, path_hash, "index")
+            for path_hash in missing
+        ]
+        # loading is mostly file reads, so threads are enough
+        workers = min(DEFAULT_THREAD_WORKERS * 4, len(missing))
+        load = functools.partial(
+            load_index, service_context=_get_service_context()
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = executor.map(load, index_paths)
+            for path_hash, index in zip(missing, loaded):
+                self.indices[path_hash]["index"] = index
 
     def is_supported_file(self, file_path):
         """Checks if a file is supported."""
+        supported = self._supported_cache.get(file_path)
+        if supported is None:
+            supported = self._is_supported_file(file_path)
+            self._supported_cache[file_path] = supported
+        return supported
+
+    def _is_supported_file(self, file_path):
+        """Checks if a file is supported, bypassing the cache."""
+        # indexed files may have been deleted since
+        if not os.path.isfile(file_path):
+            return False
         file_name = os.path.basename(file_path)
-        for pattern in self.ignored_patterns:
-            if pattern.match(file_name) is not None:
-                return False
-        if is_plain_text(file_path):
+        if self._ignored_re is not None and self._ignored_re.match(file_name):
+            return False
+        # without types only plain text files are indexed
+        if self._types is None:
+            return is_plain_text(file_path)
+        file_extension = _file_extension(file_name)
+        if file_extension not in self._types:
+            return False
+        if file_extension in READERS:
             return True
-
-        return False
-
-    def read_text(self, root, file):
-        """Reads the text from a file."""
-        file_path = os.path.join(root, file)
-        # get file extension
-        file_extension = os.path.splitext(file)[1]
-        text = None
-        if is_plain_text(file_path):
-            text = read_plain_text(file_path)
-        elif file_extension.lower() == ".pdf":
-            text = read_pdf(file_path)
-        elif file_extension.lower() == ".xlsx":
-            text = read_xlsx(file_path)
-        else:
+        return is_plain_text(file_path)
+
+    def read_text(self, root, file=None):
+        """Reads the text from a file, given by its path or folder and name."""
+        file_path = root if file is None else os.path.join(root, file)
+        return "\n".join(self.read_pages(file_path))
+
+    def read_pages(self, file_path):
+        """Reads the text from a file as a list of pages."""
+        head = read_head(file_path)
+        file_extension = _file_extension(os.path.basename(file_path))
+        # pdf files are told by their contents unless they are named as
+        # text, zip and ole files are only spreadsheets when named so
+        signature = file_signature(head)
+        if signature == file_extension or (
+            signature == ".pdf" and file_extension not in TEXT_EXTENSIONS
+        ):
+            return READERS[signature](file_path)
+        if is_text_head(head):
+            return [read_plain_text(file_path)]
+        reader = READERS.get(file_extension)
+        if reader is None:
             raise ValueError("Unsupported file type: " + file_extension)
-        return text
-
-    def has_ignore_folder(self, path):
-        """Checks if a path contains an ignored folder."""
-        if self.folder_path in path:
-            path = path.replace(self.folder_path, "")
-        folders = path.split(os.sep)
-        if any(folder in self.ignored_folders for folder in folders):
-            return True
-        return False
-
-    def build(self):
-        """Builds the index."""
-        update = False
-        # loop through all files in folder recursively
-        for root, _, files in os.walk(self.folder_path):
-            if self.has_ignore_folder(root):
-                continue
-            for file in files:
-                # check if file is supported
-                file_path = os.path.join(root, file)
-                if not self.is_supported_file(file_path):
+        return reader(file_path)
+
+    def _iter_files(self, path, depth):
+        """Yields the entries of the files below a folder."""
+        try:
+            entries = os.scandir(path)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # prune ignored folders before entering them
+                    if depth > 0 and entry.name not in self._ignored_folders:
+                        yield from self._iter_files(entry.path, depth - 1)
+                elif entry.is_file():
+                    yield entry
+
+    def discover_files(self, tasks, errors):
+        """Walks the folder and queues the files that need indexing."""
+        try:
+            seen = set()
+            for entry in self._iter_files(self.folder_path, self.depth):
+                # entry paths start with the folder path, no need for relpath
+                relative_path = entry.path[self._folder_prefix_len :]
+                seen.add(relative_path)
+                # check if file has been modified before opening it
+                modified = entry.stat().st_mtime
+                if self._modified.get(relative_path) == modified:
                     continue
-
-                depth = file_path.replace(self.folder_path, "").count(os.sep)
-                # check depth
-                if depth > self.depth:
+                # check if file is supported, it may have changed since
+                self._supported_cache.pop(entry.path, None)
+                if not self.is_supported_file(entry.path):
                     continue
-                # get relative path
-                relative_path = os.path.relpath(file_path, self.folder_path)
                 # get path hash
-                path_hash = hashlib.md5(
-                    relative_path.encode("utf-8")
-                ).hexdigest()
+                path_hash = hash_path(relative_path)
 
                 # create summary data object
                 data = {
-                    "name": file,
+                    "name": entry.name,
                     "path": relative_path,
                     "text": None,
                     "summary": "",
                 }
-                modified = os.path.getmtime(file_path)
-
-                # check if file is already indexed
-                if path_hash not in self.indices:
-                    self.indices["menu"][path_hash] = {
-                        "name": data["name"],
-                        "path": data["path"],
-                        "modified": -1,
-                    }
-                    self.indices[path_hash] = {
-                        "summary": data["summary"],
+                tasks.put(
+                    {
+                        "file_path": entry.path,
+                        "path_hash": path_hash,
+                        "modified": modified,
+                        "data": data,
                         "index": None,
                     }
-                # check if file has been modified
-                if modified == self.indices["menu"][path_hash]["modified"]:
-                    continue
-                self.indices["menu"][path_hash]["modified"] = modified
-
-                # read text
-                text = self.read_text(root, file)
-                if text is None or len(text) == 0:
-                    del self.indices["menu"][path_hash]
-                    del self.indices[path_hash]
-                    continue
-
-                # announce indexing
-                print("Indexing " + relative_path)
-                data["text"] = text
-
-                # create index folder
-                index_folder = os.path.join(self.index_path, path_hash)
-                make_dirs(index_folder)
-
-                # create index
-                index_path = os.path.join(index_folder, "index")
-                index = self.generate_index(data["text"])
-
-                # generate summary
-                data["summary"] = self.generate_summary(index)
-
-                # save summary data
-                data_path = os.path.join(index_folder, "data.json")
-                with open(data_path, "w", encoding="utf-8") as f:
-                    json.dump(data, f, indent=4)
-
-                # add to index
-                self.indices[path_hash] = {
-                    "summary": data["summary"],
-                    "index": index,
-                }
+                )
+            # indexed files that are gone are checked again when listed
+            for relative_path in list(self._modified):
+                if relative_path not in seen:
+                    file_path = os.path.join(self.folder_path, relative_path)
+                    self._supported_cache.pop(file_path, None)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            tasks.put(None)
+
+    async def fingerprint_task(self, task, executor):
+        """Hashes a queued file and marks it if its content is unchanged."""
+        loop = asyncio.get_running_loop()
+        task["content_hash"] = await loop.run_in_executor(
+            executor, hash_file, task["file_path"]
+        )
+        # skip files that were touched without changing
+        entry = self.indices["menu"].get(task["path_hash"])
+        if (
+            entry is not None
+            and entry.get("content_hash") == task["content_hash"]
+            and task["path_hash"] in self.indices
+        ):
+            task["unchanged"] = True
+        return task
+
+    async def run_embedding_task(self, task, batcher):
+        """Reads, embeds and summarises a queued file."""
+        data = task["data"]
+        # read text, a broken file is skipped instead of failing the build
+        try:
+            async with batcher.sem:
+                pages = await asyncio.to_thread(
+                    self.read_pages, task["file_path"]
+                )
+        except Exception as e:
+            print(f"Error reading file {data['path']}: {e}")
+            task["failed"] = True
+            return task
+        text = "\n".join(pages)
+        if len(text) == 0:
+            return task
+        data["text"] = text
+
+        # reuse the embedding of a renamed or copied file
+        source = self._content_index.get(task["content_hash"])
+        if source in self.indices and source != task["path_hash"]:
+            print("Reusing index of " + self.indices["menu"][source]["path"])
+            task["source"] = source
+            task["index"] = await asyncio.to_thread(self.get_index, source)
+            data["summary"] = self.indices[source]["summary"]
+            return task
+
+        # announce indexing
+        print("Indexing " + data["path"])
+
+        # create index
+        task["index"] = await batcher.embed(pages)
+
+        # generate summary
+        async with batcher.sem:
+            data["summary"] = await self.agenerate_summary(
+                task["index"], data["text"]
+            )
+        return task
+
+    async def _process_task(self, task, io_sem, errors, io_executor, batcher):
+        """Embeds a queued file and saves it, releasing its slot after."""
+        try:
+            await self.fingerprint_task(task, io_executor)
+            # only changed files wait for one of the embedding slots
+            if not task.get("unchanged"):
+                await self.run_embedding_task(task, batcher)
+            return self.save_embedding_data(task)
+        except Exception as e:
+            errors.append(e)
+            return False
+        finally:
+            io_sem.release()
+
+    async def embed_files(self, tasks, errors, executor):
+        """Embeds queued files concurrently until the walker is done."""
+        # hashing runs ahead of embedding so unchanged files are skipped
+        # without waiting for a slow embedding to finish
+        io_sem = asyncio.Semaphore(IO_WORKERS)
+        batcher = _EmbeddingBatcher(asyncio.Semaphore(self.workers), executor)
+        running = []
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as io_executor:
+            while True:
+                # take a slot before a task so the walker queue stays bounded
+                await io_sem.acquire()
+                task = await asyncio.to_thread(tasks.get)
+                if task is None:
+                    io_sem.release()
+                    break
+                running.append(
+                    asyncio.create_task(
+                        self._process_task(
+                            task, io_sem, errors, io_executor, batcher
+                        )
+                    )
+                )
+            saved = await asyncio.gather(*running)
+        return any(saved)
+
+    def save_embedding_data(self, task):
+        """Saves an embedded file and adds it to the menu."""
+        path_hash = task["path_hash"]
+        data = task["data"]
+        if task.get("unchanged"):
+            # the menu is saved once at the end of the build
+            self.indices["menu"][path_hash]["modified"] = task["modified"]
+            self._modified[data["path"]] = task["modified"]
+            return False
+
+        self._invalidate_engines(path_hash)
+        # forget the previous contents of the file
+        previous = self.indices["menu"].get(path_hash, {}).get("content_hash")
+        if self._content_index.get(previous) == path_hash:
+            del self._content_index[previous]
+        if data["text"] is None:
+            self.indices["menu"].pop(path_hash, None)
+            self.indices.pop(path_hash, None)
+            self._modified.pop(data["path"], None)
+            # files that failed to read are retried once they change
+            if task.get("failed"):
+                self._modified[data["path"]] = task["modified"]
+            return False
+
+        # create index folder
+        index_folder = os.path.join(self.index_path, path_hash)
+        make_dirs(index_folder)
+
+        # save summary data
+        data_path = os.path.join(index_folder, "data.json")
+        write_json(data_path, data)
+
+        # add to index
+        self.indices["menu"][path_hash] = {
+            "name": data["name"],
+            "path": data["path"],
+            "modified": task["modified"],
+            "content_hash": task["content_hash"],
+            "summary": data["summary"],
+        }
+        self._content_index[task["content_hash"]] = path_hash
+        self._modified[data["path"]] = task["modified"]
+        self.indices[path_hash] = {
+            "summary": data["summary"],
+            "index": task["index"],
+        }
+
+        # save index
+        index_path = os.path.join(index_folder, "index")
+        if "source" in task:
+            source = os.path.join(self.index_path, task["source"], "index")
+            link_index(source, index_path)
+        else:
+            save_index(self.indices[path_hash]["index"], index_path)
 
-                # save index
-                save_index(self.indices[path_hash]["index"], index_path)
-                update = True
+        # save menu after every file so an interrupted build keeps progress
+        self._save_menu()
+        return True
 
-        # save menu
-        if update:
-            menu_path = os.path.join(self.index_path, "menu.json")
-            with open(menu_path, "w", encoding="utf-8") as f:
-                json.dump(self.indices["menu"], f, indent=4)
+    def build(self):
+        """Builds the index."""
+        errors = []
+        # the walker feeds a bounded queue so that embedding starts as soon
+        # as the first file is found
+        tasks = queue.Queue(maxsize=4 * self.workers)
+        executor = self._get_executor()
+        walker = threading.Thread(
+            target=self.discover_files, args=(tasks, errors), daemon=True
+        )
+        walker.start()
+        try:
+            update = _run_coroutine(self.embed_files(tasks, errors, executor))
+        finally:
+            # unblock the walker if embedding stopped early
+            while walker.is_alive():
+                try:
+                    tasks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        # a lost mtime update only costs hashing the file again
+        self._save_menu()
+        if errors:
+            # start new workers on the next build if one of them died
+            if any(isinstance(e, BrokenExecutor) for e in errors):
+                self.close()
+            raise errors[0]
         return update
 
+    def _get_executor(self):
+        """Returns the embedding executor, starting it on first use."""
+        # the workers are kept between builds so that queries without
+        # changes do not start any
+        if self._executor is None:
+            options = {}
+            if self._executor_cls is ProcessPoolExecutor:
+                options["initializer"] = _init_embedding_worker
+                # a fork context leaves the global start method unset
+                options["mp_context"] = multiprocessing.get_context("fork")
+            self._executor = self._executor_cls(self.workers, **options)
+            if self._executor_cls is ProcessPoolExecutor:
+                # fork the workers before the walker thread starts
+                self._executor.submit(int).result()
+        return self._executor
+
+    def close(self):
+        """Shuts down the embedding workers."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
     def create_query_engine(self, paths=None):
         """Returns a combined index as engine."""
+        # the engine over all files is persisted between runs
+        persist = paths is None
         if paths is None:
             paths = self.get_file_list()
-
-        path_hashes = [
-            hashlib.md5(path.encode("utf-8")).hexdigest() for path in paths
-        ]
+        return self._create_engine(self._engine_key(paths), persist)
+
+    def _create_engine(self, key, persist):
+        """Returns the query engine over the files of a cache key."""
+        if key in self._engine_cache:
+            return self._engine_cache[key]
+
+        combined_index = self.load_graph(key) if persist else None
+        if combined_index is None:
+            combined_index = self.compose_graph(key)
+            if persist:
+                self.save_graph(combined_index, key)
+
+        engine = combined_index.as_query_engine()
+        self._engine_cache[key] = engine
+        return engine
+
+    def compose_graph(self, path_hashes):
+        """Composes the indices of some files under a summary index."""
+        self.load_file_indices(path_hashes)
         indices_list = []
         indices_summary = []
         for path_hash in path_hashes:
@@ -240,49 +835,112 @@ class Indexer:
             indices_summary.append(value["summary"])
 
         storage_context = StorageContext.from_defaults()
-        combined_index = ComposableGraph.from_indices(
+        return ComposableGraph.from_indices(
             ListIndex,
             indices_list,
             index_summaries=indices_summary,
             storage_context=storage_context,
+            service_context=_get_service_context(),
         )
 
-        return combined_index.as_query_engine()
+    def _graph_version(self, path_hashes):
+        """Returns a digest of the file indices a graph is composed of."""
+        # content hashes change whenever a file is embedded again, so the
+        # indices need not be loaded and touched files keep the graph
+        menu = self.indices["menu"]
+        entries = sorted(
+            path_hash + ":" + str(menu[path_hash].get("content_hash"))
+            for path_hash in path_hashes
+        )
+        return hash_strings(entries)
+
+    def save_graph(self, graph, path_hashes):
+        """Saves the summary index of a graph to the index folder."""
+        summary_path = os.path.join(self.index_path, "_summary")
+        save_index(graph.all_indices[graph.root_id], summary_path)
+        # the version is written last so a partial save is never loaded
+        version = self._graph_version(path_hashes)
+        write_json(os.path.join(summary_path, "version.json"), version)
+
+    def load_graph(self, path_hashes):
+        """Loads a saved graph if it is composed of the same indices."""
+        summary_path = os.path.join(self.index_path, "_summary")
+        version_path = os.path.join(summary_path, "version.json")
+        if not os.path.isfile(version_path):
+            return None
+        version = self._graph_version(path_hashes)
+        if read_json(version_path) != version:
+            return None
+
+        root = load_index(
+            summary_path, service_context=_get_service_context()
+        )
+        all_indices = {root.index_id: root}
+        self.load_file_indices(path_hashes)
+        for path_hash in path_hashes:
+            index = self.indices[path_hash]["index"]
+            all_indices[index.index_id] = index
+        # a file changed and changed back has a new index but the same hash
+        child_ids = {
+            node.index_id
+            for node in root.docstore.docs.values()
+            if isinstance(node, IndexNode)
+        }
+        if not child_ids.issubset(all_indices):
+            return None
+        return ComposableGraph(all_indices=all_indices, root_id=root.index_id)
+
+    def _engine_key(self, paths):
+        """Returns the cache key of the query engine over some files."""
+        return frozenset(hash_path(path) for path in paths)
+
+    def _invalidate_engines(self, path_hash):
+        """Drops the cached query engines and responses that include a file."""
+        for key in [key for key in self._engine_cache if path_hash in key]:
+            del self._engine_cache[key]
+        for key in [key for key in self._query_cache if path_hash in key[0]]:
+            del self._query_cache[key]
 
     def query(self, query):
         """Queries the index."""
         if self.build() or self.query_engine is None:
-            self.query_engine = self.create_query_engine()
+            self._query_engine_key = self._engine_key(self.get_file_list())
+            self.query_engine = self._create_engine(
+                self._query_engine_key, persist=True
+            )
+        # repeated questions over the same files reuse the response
+        key = (self._query_engine_key, query)
+        if key in self._query_cache:
+            self._query_cache.move_to_end(key)
+            return self._query_cache[key]
+
         response = self.query_engine.query(query)
+        self._query_cache[key] = response
+        if len(self._query_cache) > QUERY_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
         return response
 
     def get_file_list(self):
         """Returns a list of indexed files."""
-        files = [v["path"] for k, v in self.indices["menu"].items()]
-        # filter out ignored folders
-        files = [file for file in files if not self.has_ignore_folder(file)]
-        # filter out ignored files
-        files = [
-            file
-            for file in files
-            if self.is_supported_file(os.path.join(self.folder_path, file))
+        # ignored folders are already pruned from the menu
+        return [
+            path
+            for path in (v["path"] for v in self.indices["menu"].values())
+            if self.is_supported_file(os.path.join(self.folder_path, path))
         ]
 
-        return files
-
     def get_file_engine(self, file_path):
         """Returns a query engine for a file."""
-        path_hash = hashlib.md5(file_path.encode("utf-8")).hexdigest()
-        if path_hash not in self.indices["menu"]:
+        path_hash = hash_path(file_path)
+        if path_hash not in self.indices["menu"] or not self.is_supported_file(
+            os.path.join(self.folder_path, file_path)
+        ):
             raise ValueError("File not indexed: " + file_path)
-        index_path = os.path.join(self.index_path, path_hash, "index")
-        storage_context = StorageContext.from_defaults(persist_dir=index_path)
-        index = load_index_from_storage(storage_context)
-        file_engine = index.as_query_engine()
+        file_engine = self.get_index(path_hash).as_query_engine()
         return file_engine
 
     def get_folder_engine(self, folder_path):
         """Returns a query engine for a subfolder."""
-        all_paths = [v["path"] for k, v in self.indices["menu"].items()]
+        all_paths = self.get_file_list()
         paths = [path for path in all_paths if path.startswith(folder_path)]
         return self.create_query_engine(paths=paths)
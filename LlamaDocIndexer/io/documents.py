@@ -1,8 +1,13 @@
 """ This module contains functions for reading files. """ ""
 
+import codecs
+import json
 import os
+import shutil
 
-import pypdf
+import fitz
+import numpy as np
+import openpyxl
 import xlrd
 from llama_index import (
     SimpleDirectoryReader,
@@ -10,6 +15,46 @@ from llama_index import (
     VectorStoreIndex,
     load_index_from_storage,
 )
+from llama_index.vector_stores import SimpleVectorStore
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# bytes read from the start of a file to tell its type
+SNIFF_BYTES = 8192
+# first bytes of the binary formats that have a reader
+SIGNATURES = (
+    (b"%PDF-", ".pdf"),
+    (b"PK\x03\x04", ".xlsx"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", ".xls"),
+)
+# extensions read as text even when their first bytes look binary
+TEXT_EXTENSIONS = frozenset(
+    {
+        ".cfg",
+        ".csv",
+        ".htm",
+        ".html",
+        ".ini",
+        ".json",
+        ".log",
+        ".md",
+        ".py",
+        ".rst",
+        ".tex",
+        ".toml",
+        ".tsv",
+        ".txt",
+        ".xml",
+        ".yaml",
+        ".yml",
+    }
+)
+# vectors are kept out of the json vector store as binary float16
+VECTORS_FILE = "vectors.npy"
+VECTOR_IDS_FILE = "vector_ids.json"
 
 
 def make_dirs(folder):
@@ -18,50 +63,112 @@ def make_dirs(folder):
         os.makedirs(folder)
 
 
-def is_plain_text(path, encoding="utf-8"):
-    """Check if a file is likely a plain text file, considering UTF-8 encoding."""
+def read_json(path):
+    """Reads a json file and returns the decoded object."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json(obj):
+    """Serialises an object to json bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def write_json(path, obj):
+    """Writes an object to a json file."""
+    with open(path, "wb") as f:
+        f.write(dump_json(obj))
+
+
+def read_head(path, size=None):
+    """Reads the first bytes of a file."""
+    with open(path, "rb") as f:
+        return f.read(SNIFF_BYTES if size is None else size)
+
+
+def file_signature(head):
+    """Returns the extension of a binary format from its first bytes."""
+    for magic, extension in SIGNATURES:
+        if head.startswith(magic):
+            return extension
+    return None
+
+
+def is_text_head(head, encoding="utf-8"):
+    """Checks if the first bytes of a file decode as text."""
+    decoder = codecs.getincrementaldecoder(encoding)()
     try:
-        with open(path, "rb") as f:
-            # Try reading the file and decoding it as UTF-8 (or specified encoding)
-            # This will raise a UnicodeDecodeError if the file contains characters
-            # that can't be decoded with the specified encoding.
-            content = f.read()
-            content.decode(encoding)
+        # a character may be cut off at the end of the head
+        decoder.decode(head, final=len(head) < SNIFF_BYTES)
     except UnicodeDecodeError:
-        # If a UnicodeDecodeError is encountered, it's likely not a text file
         return False
+    return True
+
+
+def is_plain_text(path, encoding="utf-8"):
+    """Check if a file is likely a plain text file, considering UTF-8 encoding."""
+    try:
+        # the head is enough to tell text from binary files
+        head = read_head(path)
     except Exception as e:
         # Handle other potential errors (like file not found)
         print(f"Error reading file: {e}")
         return False
-    return True
+    # pdf files start with text but are not plain text, unless named so
+    extension = os.path.splitext(path)[1].lower()
+    if file_signature(head) is not None and extension not in TEXT_EXTENSIONS:
+        return False
+    return is_text_head(head, encoding)
 
 
 def read_plain_text(path):
     """Reads a plain text file and returns the text as a string."""
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        return f.read()
+    # one bulk read and decode instead of the chunked text layer
+    with open(path, "rb") as f:
+        data = f.read()
+    return data.decode("utf-8", errors="ignore")
+
+
+def iter_pdf_pages(path):
+    """Reads a pdf file and yields the text of each page."""
+    with fitz.open(path) as doc:
+        for page in doc:
+            yield page.get_text("text")
 
 
 def read_pdf(path):
     """Reads a pdf file and returns the text as a string."""
-    with open(path, "rb") as file:
-        reader = pypdf.PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+    return "\n".join(iter_pdf_pages(path))
 
 
 def read_xlsx(path):
     """Reads an xlsx file and returns the text as a string."""
+    # read only mode streams rows instead of loading the whole workbook
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    parts = []
+    try:
+        for sheet in wb.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                parts.extend(str(value) for value in row if value is not None)
+    finally:
+        wb.close()
+    return "".join(parts)
+
+
+def read_xls(path):
+    """Reads an xls file and returns the text as a string."""
     wb = xlrd.open_workbook(path)
-    text = ""
+    parts = []
     for sheet in wb.sheets():
         for row in range(sheet.nrows):
-            for col in range(sheet.ncols):
-                text += str(sheet.cell(row, col).value)
-    return text
+            # row_values returns the whole row without building Cell objects
+            parts.extend(map(str, sheet.row_values(row)))
+    return "".join(parts)
 
 
 def text_to_index(text_path):
@@ -72,11 +179,54 @@ def text_to_index(text_path):
 
 
 def save_index(index, index_path):
-    index.storage_context.persist(index_path)
+    # persist into a fresh folder so hard-linked copies are left untouched
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path)
+    vector_store = index.storage_context.vector_store
+    if not isinstance(vector_store, SimpleVectorStore):
+        index.storage_context.persist(index_path)
+        return
+
+    # persist everything but the vectors through llama_index
+    embedding_dict = vector_store._data.embedding_dict
+    vector_store._data.embedding_dict = {}
+    try:
+        index.storage_context.persist(index_path)
+    finally:
+        vector_store._data.embedding_dict = embedding_dict
+    ids = list(embedding_dict)
+    vectors = np.array([embedding_dict[i] for i in ids], dtype=np.float16)
+    np.save(os.path.join(index_path, VECTORS_FILE), vectors)
+    write_json(os.path.join(index_path, VECTOR_IDS_FILE), ids)
+
+
+def link_index(source_path, index_path):
+    """Copies a saved index, hard-linking the files where possible."""
+
+    def link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path)
+    shutil.copytree(source_path, index_path, copy_function=link)
 
 
-def load_index(index_path):
+def load_index(index_path, service_context=None):
     # rebuild storage context
     storage_context = StorageContext.from_defaults(persist_dir=index_path)
+    # restore the vectors of indices saved in binary
+    vectors_path = os.path.join(index_path, VECTORS_FILE)
+    if os.path.isfile(vectors_path):
+        ids = read_json(os.path.join(index_path, VECTOR_IDS_FILE))
+        # the vector store keeps python lists, so the whole array is read
+        vectors = np.load(vectors_path)
+        storage_context.vector_store._data.embedding_dict = dict(
+            zip(ids, vectors.astype(np.float32).tolist())
+        )
     # load index
-    return load_index_from_storage(storage_context)
+    return load_index_from_storage(
+        storage_context, service_context=service_context
+    )
@@ -0,0 +1,31 @@
+""" Contains utility functions for hashing paths and files. """
+
+import mmap
+import os
+
+import xxhash
+
+
+def hash_path(path):
+    """Returns the key under which the index of a relative path is stored."""
+    return xxhash.xxh3_128_hexdigest(path.encode("utf-8"))
+
+
+def hash_strings(strings):
+    """Returns a digest of a sequence of strings."""
+    hasher = xxhash.xxh3_128()
+    for string in strings:
+        # the separator keeps ("ab", "c") apart from ("a", "bc")
+        hasher.update(string.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def hash_file(path):
+    """Returns a fingerprint of the contents of a file."""
+    with open(path, "rb") as f:
+        # empty files cannot be memory mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return xxhash.xxh3_128_hexdigest(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return xxhash.xxh3_128_hexdigest(mm)
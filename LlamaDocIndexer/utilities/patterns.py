@@ -5,12 +5,23 @@ import re
 
 def wildcard_to_regex(wildcard):
     """Converts a wildcard pattern to a regex pattern."""
+    # Runs of '*' match the same names as one and only add backtracking
+    wildcard = re.sub(r"\*+", "*", wildcard)
     # Escape regex special characters, except for '*'
-    escaped = re.escape(wildcard).replace("\\*", ".*")
-    # Add anchors to match the start and end of the string
-    return r"^" + escaped + r"$"
+    escaped = re.escape(wildcard).replace("\\*", "[^/]*")
+    # Add anchors to match the start and end of the whole string
+    return r"\A" + escaped + r"\Z"
 
 
 def ignored_files_to_patterns(ignored_files):
     """Converts a list of wildcard patterns to regex patterns."""
     return [re.compile(wildcard_to_regex(p)) for p in ignored_files]
+
+
+def ignored_files_to_regex(ignored_files):
+    """Combines a list of wildcard patterns into one regex, or None."""
+    if not ignored_files:
+        return None
+    return re.compile(
+        "|".join(f"(?:{wildcard_to_regex(p)})" for p in ignored_files)
+    )
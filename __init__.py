@@ -1 +1 @@
-from .LlamaDocIndexer.indexer import LlamaDocIndexer
+from .LlamaDocIndexer import Indexer
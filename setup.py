@@ -14,4 +14,5 @@ setup(
     url="https://github.com/chenjiayi8/LlamaDocIndexer",
     download_url="https://pypi.org/project/LlamaDocIndexer/",
     install_requires=required,
+    extras_require={"onnx": ["optimum[onnxruntime]"]},
 )